@@ -1,9 +1,27 @@
+import argparse
+import asyncio
+import glob
+import json
 import math
+import mmap
+import os
+import pickle
+import queue
+import shutil
 import textwrap
-import shelve
+import struct
+import threading
+import time
+import zlib
+from collections import deque, namedtuple
 
 import libtcodpy as libtcod
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
 INVENTORY_WIDTH = 50
 HEAL_AMOUNT = 4
 
@@ -20,6 +38,9 @@ LIMIT_FPS = 20
 ROOM_MAX_SIZE = 10
 ROOM_MIN_SIZE = 6
 MAX_ROOMS = 30
+CAVE_WALL_CHANCE = 45  # percent of cave tiles that start as walls
+CAVE_SMOOTHING_STEPS = 4
+DRUNKARD_FLOOR_PERCENT = 40  # how much of the map the drunkard digs out
 
 
 # sizes and coordinates relevant for the GUI
@@ -36,18 +57,236 @@ FOV_ALGO = 0  # default FOV algorithm
 FOV_LIGHT_WALLS = True
 TORCH_RADIUS = 10
 
+LIGHT_LEVELS = 16  # shades between the dark and the fully lit color of a tile
+LIGHTNING_FLASH_RADIUS = 4
+LIGHTNING_FLASH_FRAMES = 2  # how many frames a lightning flash stays lit
+
 MAP_WIDTH = 80
 MAP_HEIGHT = 45
 
+# recorded games store a hash of the game state every so many turns
+CHECKPOINT_INTERVAL = 100
+RECORDING_MAGIC = b"RLRC"
+
+# the terrain and the explored tiles of a saved game are kept in a file of their own,
+# with one bit per tile, under a name no other save uses. the map being played on is
+# kept in the scratch file until the game is saved. the rest of a save is written to
+# its scratch name first, and only renamed over the old one once it's complete
+SAVE_FILE = "savegame"
+SAVE_SCRATCH_FILE = "savegame.new"
+MAP_FILE = "savegame-%08x.map"
+MAP_FILES = "savegame-*.map"
+MAP_SCRATCH_FILE = "savegame.map.new"
+MAP_FILE_MAGIC = b"RLMP"
+MAP_HEADER = struct.Struct("<4sHHI")  # magic, width, height, id of the game
+
+# the event log file is written in batches of up to this many events, waiting at most
+# this many seconds for a batch to fill up
+EVENT_LOG_BATCH = 256
+EVENT_LOG_FLUSH_DELAY = 0.5
+
+# a spectator that has this many bytes waiting to be sent skips frames until it catches up
+SPECTATOR_MAX_BUFFER = 256 * 1024
+
+# auto-explore and travel stop after this many turns, even if there's more to do
+MAX_BATCH_TURNS = 1000
+
+# how many turns the player can rewind
+REWIND_DEPTH = 20
+
+# the player's possible next steps, guessed ahead while waiting for a key
+PREFETCH_MOVES = ((0, -1), (0, 1), (-1, 0), (1, 0), (0, 0))
+
+# render layers, drawn from the bottom up: only the top glyph of each tile is shown
+LAYER_ITEM = 0
+LAYER_CORPSE = 1
+LAYER_ACTOR = 2
+LAYER_PLAYER = 3
+NUM_LAYERS = 4
+
 color_dark_wall = libtcod.Color(0, 0, 100)
 color_dark_ground = libtcod.Color(50, 50, 150)
 color_light_wall = libtcod.Color(130, 110, 50)
 color_light_ground = libtcod.Color(200, 180, 50)
 
+# the color of walls and ground for every light level, from dark to fully lit
+wall_light_ramp = [
+    libtcod.color_lerp(color_dark_wall, color_light_wall, float(level) / (LIGHT_LEVELS - 1))
+    for level in range(LIGHT_LEVELS)
+]
+ground_light_ramp = [
+    libtcod.color_lerp(color_dark_ground, color_light_ground, float(level) / (LIGHT_LEVELS - 1))
+    for level in range(LIGHT_LEVELS)
+]
+
 
 game_state = "playing"
 player_action = None
 
+# bumped whenever lights that don't move are added to or taken off the map
+map_revision = 0
+map_generator = "rooms"  # one of MAP_GENERATORS
+map = None  # the current DungeonMap
+map_file = MAP_SCRATCH_FILE  # where new maps are kept, or None to keep them only in memory
+
+# while a game is being recorded or replayed, every key press goes through these
+recording = None
+replay_keys = None
+
+# the con cells drawn since the spectators last got a frame, or None when they need
+# the whole screen again
+changed_cells = None
+panel_changed = False
+
+# the next turn, worked out while waiting for the player's key
+prefetch = None
+prefetched_fov = None
+last_move = (0, 0)
+
+# while snapshots are kept, the old value of everything that changes goes here
+journal = None
+journal_start = 0  # how many entries were dropped from the front of the journal
+restore_points = []  # the journal position each restore went back to, oldest first
+restore_points_start = 0  # how many restore points were dropped from the front
+rewind_snapshots = deque(maxlen=REWIND_DEPTH)
+
+
+####### SNAPSHOTS
+#
+# snapshots don't copy the world. while any are kept, every attribute set on the
+# game's objects (and every item added to or taken from the objects and inventory
+# lists, and every explored tile of the map) records the old value in a journal, and a
+# snapshot is just a position in it: taking one costs nothing, and going back to one
+# undoes only what changed since.
+#
+# going back to a snapshot throws away everything after it, so the snapshots taken
+# since then can't be restored any more: any of them can be forked from again and
+# again, but once one is restored, the newer ones are stale.
+
+
+MISSING = object()  # an attribute that didn't exist yet
+APPENDED = object()  # an item added to the end of a list
+REMOVED = object()  # an item taken out of a list
+
+Snapshot = namedtuple("Snapshot", ["position", "generation", "game_state", "rng"])
+
+
+class Journaled:
+    # base for the classes whose changes can be undone. the journaling __setattr__ is
+    # only put in place while snapshots are kept, so the rest of the time setting an
+    # attribute costs no more than on any other object
+    pass
+
+
+def journaled_setattr(self, name, value):
+    journal.append((self, name, self.__dict__.get(name, MISSING)))
+    object.__setattr__(self, name, value)
+
+
+def journaled_append(list, item):
+    if journal is not None:
+        journal.append((list, APPENDED, None))
+    list.append(item)
+
+
+def journaled_remove(list, item):
+    index = list.index(item)
+    if journal is not None:
+        journal.append((list, REMOVED, (index, item)))
+    del list[index]
+
+
+def save_snapshot():
+    global journal
+    if journal is None:
+        journal = []
+        Journaled.__setattr__ = journaled_setattr
+    return Snapshot(journal_start + len(journal), restore_points_start + len(restore_points),
+                    game_state, libtcod.random_save(rng))
+
+
+def is_stale(snapshot):
+    # the journal was cut back past the snapshot since it was taken
+    if (journal is None or snapshot.position < journal_start
+            or snapshot.generation < restore_points_start):
+        return True
+    return any(
+        position < snapshot.position
+        for position in restore_points[snapshot.generation - restore_points_start:]
+    )
+
+
+def restore_snapshot(snapshot):
+    # undo everything done since the snapshot, newest first
+    global game_state, fov_recompute, map_revision
+
+    if is_stale(snapshot):
+        raise ValueError("the snapshot is stale: the journal was cut back past it")
+
+    while journal_start + len(journal) > snapshot.position:
+        (target, name, old) = journal.pop()
+        if name is APPENDED:
+            target.pop()
+        elif name is REMOVED:
+            target.insert(*old)
+        elif isinstance(target, BitLayer):
+            target.write(name, old)
+        elif old is MISSING:
+            object.__delattr__(target, name)
+        else:
+            object.__setattr__(target, name, old)
+
+    restore_points.append(snapshot.position)
+    game_state = snapshot.game_state
+    libtcod.random_restore(rng, snapshot.rng)
+    map_revision += 1  # items may have come back, with their lights
+
+    # monsters look at the FOV map, so it must match where the player is again
+    fov_recompute = True
+    compute_fov()
+
+
+def forget_before(snapshot):
+    # nothing older than this snapshot will be restored: drop that part of the journal
+    global journal_start, restore_points_start
+    del journal[:snapshot.position - journal_start]
+    journal_start = snapshot.position
+
+    # a restore that went back to before the new start made every snapshot taken before
+    # it stale, so that restore and the ones before it needn't be kept anymore
+    for i in range(len(restore_points) - 1, -1, -1):
+        if restore_points[i] < journal_start:
+            del restore_points[:i + 1]
+            restore_points_start += i + 1
+            break
+
+
+def reset_snapshots():
+    # a new game, a loaded one, or back to the menu: no going back past this point
+    global journal, journal_start, restore_points_start
+    journal = None
+    journal_start = 0
+    del restore_points[:]
+    restore_points_start = 0
+    rewind_snapshots.clear()
+    if "__setattr__" in Journaled.__dict__:
+        del Journaled.__setattr__
+
+
+def keep_rewind_point(snapshot):
+    # the player took a turn: they can come back to right before it
+    rewind_snapshots.append(snapshot)
+    forget_before(rewind_snapshots[0])
+
+
+def rewind():
+    if not rewind_snapshots:
+        message("You can't go back any further.", libtcod.red)
+        return
+    stop_prefetch()  # the world is about to change
+    restore_snapshot(rewind_snapshots.pop())
+    message("You rewind time by one turn.", libtcod.light_violet)
+
 
 ####### OBJECTS
 
@@ -58,7 +297,7 @@ def cast_heal():
         message("You are already at full health.", libtcod.red)
         return "cancelled"
 
-    message("Your wounds start to feel better!", libtcod.light_violet)
+    emit(SpellEvent("heal", player.name, HEAL_AMOUNT))
     player.fighter.heal(HEAL_AMOUNT)
 
 
@@ -73,7 +312,7 @@ def cast_confuse():
     old_ai = monster.ai
     monster.ai = ConfusedMonster(old_ai)
     monster.ai.owner = monster  #tell the new component who owns it
-    message('The eyes of the ' + monster.name + ' look vacant, as he starts to stumble around!', libtcod.light_green)
+    emit(SpellEvent("confusion", monster.name, 0))
 
 
 def closest_monster(max_range):
@@ -98,12 +337,12 @@ def cast_lightning():
         return 'cancelled'
 
     #zap it!
-    message('A lighting bolt strikes the ' + monster.name + ' with a loud thunder! The damage is '
-        + str(LIGHTNING_DAMAGE) + ' hit points.', libtcod.light_blue)
+    emit(SpellEvent("lightning", monster.name, LIGHTNING_DAMAGE))
+    flashes.append([monster.x, monster.y, LIGHTNING_FLASH_RADIUS, LIGHTNING_FLASH_FRAMES])
     monster.fighter.take_damage(LIGHTNING_DAMAGE)
 
 
-class Item:
+class Item(Journaled):
     """
     an item that can be picked up and used.
 
@@ -118,54 +357,70 @@ class Item:
             message("The " + self.owner.name + " cannot be used.")
         else:
             if self.use_function() != "cancelled":
-                inventory.remove(
-                    self.owner
-                )  # destroy after use, unless it was cancelled for some reason
+                # destroy after use, unless it was cancelled for some reason
+                journaled_remove(inventory, self.owner)
+                emit(UseEvent(self.owner.name))
 
     def drop(self):
         #add to the map and remove from the player's inventory. also, place it at the player's coordinates
-        objects.append(self.owner)
-        inventory.remove(self.owner)
+        global map_revision
+        journaled_append(objects, self.owner)
+        journaled_remove(inventory, self.owner)
         self.owner.x = player.x
         self.owner.y = player.y
-        message('You dropped a ' + self.owner.name + '.', libtcod.yellow)
+        map_revision += 1
+        emit(DropEvent(self.owner.name))
 
     def pick_up(self):
         # add to the player's inventory and remove from the map
+        global map_revision
         if len(inventory) >= 26:
             message(
                 "Your inventory is full, cannot pick up " + self.owner.name + ".",
                 libtcod.red,
             )
         else:
-            inventory.append(self.owner)
-            objects.remove(self.owner)
-            message("You picked up a " + self.owner.name + "!", libtcod.green)
+            journaled_append(inventory, self.owner)
+            journaled_remove(objects, self.owner)
+            map_revision += 1
+            emit(PickUpEvent(self.owner.name))
+
+
+class Light(Journaled):
+    # a light source: lights up the tiles it can see, fading out with distance
+    def __init__(self, radius, intensity=1.0):
+        self.radius = radius
+        self.intensity = intensity
 
 
-class ConfusedMonster:
+class ConfusedMonster(Journaled):
     #AI for a temporarily confused monster (reverts to previous AI after a while).
     def __init__(self, old_ai, num_turns=CONFUSE_NUM_TURNS):
         self.old_ai = old_ai
         self.num_turns = num_turns
 
-    def take_turn(self):
+    def plan_turn(self, snapshot):
         if self.num_turns > 0:  #still confused...
+            return ('stumble',)
+        return ('recover',)
+
+    def carry_out(self, action):
+        if action[0] == 'stumble':
             #move in a random direction, and decrease the number of turns confused
-            self.owner.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+            self.owner.move(libtcod.random_get_int(rng, -1, 1), libtcod.random_get_int(rng, -1, 1))
             self.num_turns -= 1
 
-        else:  #restore the previous AI (this one will be deleted because it's not referenced anymore)
+        elif action[0] == 'recover':  #restore the previous AI (this one will be deleted because it's not referenced anymore)
             self.owner.ai = self.old_ai
             message('The ' + self.owner.name + ' is no longer confused!', libtcod.red)
 
 
-
-class Object:
+class Object(Journaled):
     # this is a generic object: the player, a monster, an item, the stairs...
     # it's always represented by a character on screen.
     def __init__(
-        self, x, y, char, name, color, blocks=False, fighter=None, ai=None, item=None
+        self, x, y, char, name, color, blocks=False, fighter=None, ai=None, item=None,
+        layer=LAYER_ACTOR, light=None
     ):
         self.x = x
         self.y = y
@@ -173,6 +428,7 @@ class Object:
         self.color = color
         self.name = name
         self.blocks = blocks
+        self.layer = layer
 
         self.item = item
         if self.item:  # let the Item component know who owns it
@@ -186,25 +442,23 @@ class Object:
         if self.ai:  # let the AI component know who owns it
             self.ai.owner = self
 
+        self.light = light
+        if self.light:  # let the Light component know who owns it
+            self.light.owner = self
+
     def move(self, dx, dy):
         if not is_blocked(self.x + dx, self.y + dy):
             # move by the given amount
             self.x += dx
             self.y += dy
 
-    def send_to_back(self):
-        # make this object be drawn first, so all others appear above it if they're in the same tile.
-        global objects
-        objects.remove(self)
-        objects.insert(0, self)
-
     def distance_to(self, other):
         # return the distance to another object
         dx = other.x - self.x
         dy = other.y - self.y
         return math.sqrt(dx ** 2 + dy ** 2)
 
-    def move_towards(self, target_x, target_y):
+    def step_towards(self, target_x, target_y):
         # vector from this object to the target, and distance
         dx = target_x - self.x
         dy = target_y - self.y
@@ -214,20 +468,10 @@ class Object:
         # convert to integer so the movement is restricted to the map grid
         dx = int(round(dx / distance))
         dy = int(round(dy / distance))
-        self.move(dx, dy)
-
-    def draw(self):
-        if libtcod.map_is_in_fov(fov_map, self.x, self.y):
-            # set the color and then draw the character that represents this object at its position
-            libtcod.console_set_default_foreground(con, self.color)
-            libtcod.console_put_char(con, self.x, self.y, self.char, libtcod.BKGND_NONE)
+        return (dx, dy)
 
-    def clear(self):
-        # erase the character that represents this object
-        libtcod.console_put_char(con, self.x, self.y, " ", libtcod.BKGND_NONE)
 
-
-class Fighter:
+class Fighter(Journaled):
     # combat-related properties and methods (monster, player, NPC).
     def __init__(self, hp, defense, power, death_function=None):
         self.max_hp = hp
@@ -257,60 +501,205 @@ class Fighter:
         # a simple formula for attack damage
         damage = self.power - target.fighter.defense
 
+        emit(AttackEvent(self.owner.name, target.name, damage))
         if damage > 0:
             # make the target take some damage
-            message(
-                self.owner.name.capitalize()
-                + " attacks "
-                + target.name
-                + " for "
-                + str(damage)
-                + " hit points.",
-                libtcod.red,
-            )
             target.fighter.take_damage(damage)
-        else:
-            message(
-                self.owner.name.capitalize()
-                + " attacks "
-                + target.name
-                + " but it has no effect!",
-                libtcod.green,
-            )
 
 
-class BasicMonster:
+class BasicMonster(Journaled):
     # AI for a basic monster.
-    def take_turn(self):
-        # a basic monster takes its turn. If you can see it, it can see you
+    def plan_turn(self, snapshot):
+        # decide what to do, looking only at the snapshot: nothing is moved here, so
+        # every monster plans against the same world. If you can see it, it can see you
         monster = self.owner
+        (player_x, player_y, player_hp) = snapshot
         if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
 
             # move towards player if far away
-            if monster.distance_to(player) >= 2:
-                monster.move_towards(player.x, player.y)
+            if math.sqrt((player_x - monster.x) ** 2 + (player_y - monster.y) ** 2) >= 2:
+                (dx, dy) = monster.step_towards(player_x, player_y)
+                return ('move', dx, dy)
 
             # close enough, attack! (if the player is still alive.)
-            elif player.fighter.hp > 0:
-                monster.fighter.attack(player)
+            elif player_hp > 0:
+                return ('attack',)
+        return None
+
+    def carry_out(self, action):
+        monster = self.owner
+        if action[0] == 'move':
+            # the tile may have been taken by a monster that acted earlier this turn
+            monster.move(action[1], action[2])
+
+        elif action[0] == 'attack' and player.fighter.hp > 0:
+            monster.fighter.attack(player)
+
+
+def take_snapshot():
+    # the part of the world the monsters look at when deciding what to do
+    return (player.x, player.y, player.fighter.hp)
+
+
+def monsters_take_turn(prefetched=None):
+    # first every monster decides what to do against the same snapshot of the world,
+    # then the actions are carried out one by one
+    # in the order of the objects list, so the first monster to claim a tile gets it
+    # and a game always plays out the same way
+    ais = [object.ai for object in objects if object.ai]
+    snapshot = take_snapshot()
+
+    if prefetched is not None:
+        # most plans were made while waiting for the player; plan only the new AIs
+        plans = [
+            prefetched[ai] if ai in prefetched else ai.plan_turn(snapshot)
+            for ai in ais
+        ]
+    else:
+        plans = [ai.plan_turn(snapshot) for ai in ais]
+
+    for ai, plan in zip(ais, plans):
+        # skip monsters that died or changed their mind (e.g. were confused) meanwhile
+        if plan is not None and ai.owner.ai is ai:
+            ai.carry_out(plan)
+
+
+#### EVENTS
+#
+# things that happen in the game are emitted as events. the message log and the
+# event log file subscribe to them; the message log only turns them into text
+# when it draws them
+
+
+class Message(namedtuple("Message", ["text", "color"])):
+    def describe(self):
+        return (self.text, self.color)
+
+
+class AttackEvent(namedtuple("AttackEvent", ["attacker", "target", "damage"])):
+    def describe(self):
+        if self.damage > 0:
+            return (
+                self.attacker.capitalize() + " attacks " + self.target + " for "
+                + str(self.damage) + " hit points.",
+                libtcod.red,
+            )
+        return (
+            self.attacker.capitalize() + " attacks " + self.target + " but it has no effect!",
+            libtcod.green,
+        )
+
+
+class SpellEvent(namedtuple("SpellEvent", ["spell", "target", "amount"])):
+    def describe(self):
+        if self.spell == "heal":
+            return ("Your wounds start to feel better!", libtcod.light_violet)
+        if self.spell == "confusion":
+            return (
+                "The eyes of the " + self.target + " look vacant, as he starts to stumble around!",
+                libtcod.light_green,
+            )
+        return (
+            "A lighting bolt strikes the " + self.target + " with a loud thunder! The damage is "
+            + str(self.amount) + " hit points.",
+            libtcod.light_blue,
+        )
+
+
+class DeathEvent(namedtuple("DeathEvent", ["victim", "player"])):
+    def describe(self):
+        if self.player:
+            return ("You died!", libtcod.red)
+        return (self.victim.capitalize() + " is dead!", libtcod.green)
+
+
+class PickUpEvent(namedtuple("PickUpEvent", ["item"])):
+    def describe(self):
+        return ("You picked up a " + self.item + "!", libtcod.green)
+
+
+class DropEvent(namedtuple("DropEvent", ["item"])):
+    def describe(self):
+        return ("You dropped a " + self.item + ".", libtcod.yellow)
+
+
+class UseEvent(namedtuple("UseEvent", ["item"])):
+    pass
+
+
+EVENT_TYPES = (AttackEvent, SpellEvent, DeathEvent, PickUpEvent, DropEvent, UseEvent)
+
+event_handlers = {}  # event type -> functions called with every event of that type
+
+
+def subscribe(handler, *event_types):
+    for event_type in event_types:
+        event_handlers.setdefault(event_type, []).append(handler)
+
+
+def emit(event):
+    for handler in event_handlers.get(type(event), ()):
+        handler(event)
+
+
+class EventLogSink:
+    # appends every event to a JSON lines file. the game only puts events on a
+    # queue; a background thread turns them into JSON and writes them in batches
+    def __init__(self, filename):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, args=(filename,), daemon=True)
+        self.thread.start()
+
+    def __call__(self, event):
+        self.queue.put((game_seed, event))
+
+    def run(self, filename):
+        with open(filename, "a") as file:
+            done = False
+            while not done:
+                batch = [self.queue.get()]
+                # take whatever else comes in shortly, up to a full batch
+                while len(batch) < EVENT_LOG_BATCH:
+                    try:
+                        batch.append(self.queue.get(timeout=EVENT_LOG_FLUSH_DELAY))
+                    except queue.Empty:
+                        break
+
+                lines = []
+                for entry in batch:
+                    if entry is None:  # closing
+                        done = True
+                        continue
+                    (seed, event) = entry
+                    record = {"event": type(event).__name__, "seed": seed}
+                    record.update(event._asdict())
+                    lines.append(json.dumps(record) + "\n")
+                file.write("".join(lines))
+                file.flush()
+
+    def close(self):
+        # write out whatever is left and wait for it
+        self.queue.put(None)
+        self.thread.join()
 
 
 # create the list of game messages and their colors, starts empty
 game_msgs = []
 
 
+def log_event(event):
+    # keep the event in the message log, making room for it if the log is full.
+    # every entry takes at least one line, so the log never needs more than MSG_HEIGHT
+    if len(game_msgs) == MSG_HEIGHT:
+        del game_msgs[0]
+    game_msgs.append(event)
+
+
 def message(new_msg, color=libtcod.white):
-    global game_msgs
-    # split the message if necessary, among multiple lines
-    new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
+    log_event(Message(new_msg, color))
 
-    for line in new_msg_lines:
-        # if the buffer is full, remove the first line to make room for the new one
-        if len(game_msgs) == MSG_HEIGHT:
-            del game_msgs[0]
 
-        # add the new line as a tuple, with the text and the color
-        game_msgs.append((line, color))
+subscribe(log_event, AttackEvent, SpellEvent, DeathEvent, PickUpEvent, DropEvent)
 
 
 def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
@@ -341,7 +730,7 @@ def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
 def player_death(player):
     # the game ended!
     global game_state
-    message("You died!", libtcod.red)
+    emit(DeathEvent(player.name, True))
     game_state = "dead"
 
     # for added effect, transform the player into a corpse!
@@ -352,90 +741,131 @@ def player_death(player):
 def monster_death(monster):
     # transform it into a nasty corpse! it doesn't block, can't be
     # attacked and doesn't move
-    message(monster.name.capitalize() + " is dead!", libtcod.green)
+    emit(DeathEvent(monster.name, False))
     monster.char = "%"
     monster.color = libtcod.dark_red
     monster.blocks = False
     monster.fighter = None
     monster.ai = None
     monster.name = "remains of " + monster.name
-    monster.send_to_back()
+    monster.layer = LAYER_CORPSE  # drawn below living monsters and the player
+
+
+class AliasTable:
+    # picks one of several choices, with the given weights, in constant time
+    # (Vose's alias method): one random column, then a coin flip between the
+    # column's own choice and its alias
+    def __init__(self, entries):
+        n = len(entries)
+        total = float(sum(weight for (weight, choice) in entries))
+        self.choices = [choice for (weight, choice) in entries]
+        self.odds = [1.0] * n
+        self.alias = list(range(n))
+
+        scaled = [weight * n / total for (weight, choice) in entries]
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            # the column of a rare choice is topped up with a common one
+            self.odds[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
 
+    def pick(self):
+        i = libtcod.random_get_int(rng, 0, len(self.choices) - 1)
+        if libtcod.random_get_float(rng, 0.0, 1.0) < self.odds[i]:
+            return self.choices[i]
+        return self.choices[self.alias[i]]
 
-def place_objects(room):
-    # choose random number of monsters
-    num_monsters = libtcod.random_get_int(0, 0, MAX_ROOM_MONSTERS)
 
-    for i in range(num_monsters):
-        # choose random spot for this monster
-        x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+def create_orc(x, y):
+    fighter_component = Fighter(hp=10, defense=0, power=3, death_function=monster_death)
+    ai_component = BasicMonster()
+    return Object(x, y, "o", "orc", libtcod.desaturated_green,
+                  blocks=True, fighter=fighter_component, ai=ai_component)
 
-        if libtcod.random_get_int(0, 0, 100) < 80:  # 80% chance of getting an orc
-            # create an orc
-            fighter_component = Fighter(
-                hp=10, defense=0, power=3, death_function=monster_death
-            )
-            ai_component = BasicMonster()
-
-            monster = Object(
-                x,
-                y,
-                "o",
-                "orc",
-                libtcod.desaturated_green,
-                blocks=True,
-                fighter=fighter_component,
-                ai=ai_component,
-            )
-        else:
-            # create a troll
-            fighter_component = Fighter(
-                hp=16, defense=1, power=4, death_function=monster_death
-            )
-            ai_component = BasicMonster()
-
-            monster = Object(
-                x,
-                y,
-                "T",
-                "troll",
-                libtcod.darker_green,
-                blocks=True,
-                fighter=fighter_component,
-                ai=ai_component,
-            )
 
-        # only place it if the tile is not blocked
-        if not is_blocked(x, y):
-            objects.append(monster)
-
-    # choose random number of items
-    num_items = libtcod.random_get_int(0, 0, MAX_ROOM_ITEMS)
-
-    for i in range(num_items):
-        # choose random spot for this item
-        x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
-
-        # only place it if the tile is not blocked
-        if not is_blocked(x, y):
-            dice = libtcod.random_get_int(0, 0, 100)
-            if dice < 70:
-                #create a healing potion (70% chance)
-                item_component = Item(use_function=cast_heal)
-                item = Object(x, y, '!', 'healing potion', libtcod.violet, item=item_component)
-            elif dice < 70+15:
-                #create a lightning bolt scroll (15% chance)
-                item_component = Item(use_function=cast_lightning)
-                item = Object(x, y, '#', 'scroll of lightning bolt', libtcod.light_yellow, item=item_component)
-            else:
-                #create a confuse scroll (15% chance)
-                item_component = Item(use_function=cast_confuse)
-                item = Object(x, y, '#', 'scroll of confusion', libtcod.light_yellow, item=item_component)
+def create_troll(x, y):
+    fighter_component = Fighter(hp=16, defense=1, power=4, death_function=monster_death)
+    ai_component = BasicMonster()
+    return Object(x, y, "T", "troll", libtcod.darker_green,
+                  blocks=True, fighter=fighter_component, ai=ai_component)
+
+
+def create_healing_potion(x, y):
+    item_component = Item(use_function=cast_heal)
+    return Object(x, y, '!', 'healing potion', libtcod.violet, item=item_component,
+                  layer=LAYER_ITEM)
+
 
-            objects.append(item)
-            item.send_to_back()  # items appear below other objects
+def create_lightning_scroll(x, y):
+    item_component = Item(use_function=cast_lightning)
+    return Object(x, y, '#', 'scroll of lightning bolt', libtcod.light_yellow, item=item_component,
+                  layer=LAYER_ITEM, light=Light(2, 0.5))
+
+
+def create_confusion_scroll(x, y):
+    item_component = Item(use_function=cast_confuse)
+    return Object(x, y, '#', 'scroll of confusion', libtcod.light_yellow, item=item_component,
+                  layer=LAYER_ITEM)
+
+
+# what spawns, and how often (relative weights)
+MONSTER_SPAWN_TABLE = AliasTable([
+    (80, create_orc),
+    (20, create_troll),
+])
+ITEM_SPAWN_TABLE = AliasTable([
+    (70, create_healing_potion),
+    (15, create_lightning_scroll),
+    (15, create_confusion_scroll),
+])
+
+
+def create_monster(x, y):
+    return MONSTER_SPAWN_TABLE.pick()(x, y)
+
+
+def create_item(x, y):
+    return ITEM_SPAWN_TABLE.pick()(x, y)
+
+
+def take_random_tiles(tiles, count):
+    # shuffle just enough of the list to take count different random tiles from it
+    count = min(count, len(tiles))
+    for i in range(count):
+        j = libtcod.random_get_int(rng, i, len(tiles) - 1)
+        tiles[i], tiles[j] = tiles[j], tiles[i]
+    return tiles[:count]
+
+
+def place_objects(room, occupied):
+    # the free floor tiles inside the room: every spawn gets one of its own, so
+    # nothing is dropped for landing on a taken tile
+    free = [
+        (x, y)
+        for x in range(room.x1 + 1, room.x2)
+        for y in range(room.y1 + 1, room.y2)
+        if not map.blocked[x, y] and (x, y) not in occupied
+    ]
+
+    # choose random number of monsters and items
+    num_monsters = libtcod.random_get_int(rng, 0, MAX_ROOM_MONSTERS)
+    num_items = libtcod.random_get_int(rng, 0, MAX_ROOM_ITEMS)
+
+    tiles = take_random_tiles(free, num_monsters + num_items)
+    for i, (x, y) in enumerate(tiles):
+        if i < num_monsters:
+            objects.append(create_monster(x, y))
+        else:
+            objects.append(create_item(x, y))
+        occupied.add((x, y))
 
 
 class Rect:
@@ -461,57 +891,92 @@ class Rect:
         )
 
 
-def create_h_tunnel(x1, x2, y):
+def create_h_tunnel(terrain, x1, x2, y):
     x1 = int(x1)
     x2 = int(x2)
     y = int(y)
 
-    global map
-    for x in range(min(x1, x2), max(x1, x2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+    # a horizontal tunnel is one run of the row, cleared in a single slice
+    start = y * MAP_WIDTH + min(x1, x2)
+    length = abs(x2 - x1) + 1
+    terrain[start:start + length] = bytes(length)
 
 
-def create_v_tunnel(y1, y2, x):
+def create_v_tunnel(terrain, y1, y2, x):
     y1 = int(y1)
     y2 = int(y2)
     x = int(x)
 
-    global map
-    # vertical tunnel
-    for y in range(min(y1, y2), max(y1, y2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
-
-
-def create_room(room):
-    global map
-    # go through the tiles in the rectangle and make them passable
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            map[x][y].blocked = False
-            map[x][y].block_sight = False
+    # vertical tunnel: every MAP_WIDTH-th cell of the terrain, cleared in a single slice
+    start = min(y1, y2) * MAP_WIDTH + x
+    length = abs(y2 - y1) + 1
+    terrain[start:start + (length - 1) * MAP_WIDTH + 1:MAP_WIDTH] = bytes(length)
 
 
-def make_map():
-    global map, objects
+def create_room(terrain, room):
+    # make the inside of the rectangle passable, one row slice at a time
+    width = room.x2 - room.x1 - 1
+    for y in range(room.y1 + 1, room.y2):
+        start = y * MAP_WIDTH + room.x1 + 1
+        terrain[start:start + width] = bytes(width)
 
-    #the list of objects with just the player
-    objects = [player]
 
-    # fill map with "blocked" tiles
-    map = [[Tile(True) for y in range(MAP_HEIGHT)] for x in range(MAP_WIDTH)]
+def connect_rooms(terrain, room, other_room):
+    # join the centers of two rooms with an L-shaped tunnel
+    (x1, y1) = room.center()
+    (x2, y2) = other_room.center()
 
+    # draw a coin (random number that is either 0 or 1)
+    if libtcod.random_get_int(rng, 0, 1) == 1:
+        # first move horizontally, then vertically
+        create_h_tunnel(terrain, x1, x2, y1)
+        create_v_tunnel(terrain, y1, y2, x2)
+    else:
+        # first move vertically, then horizontally
+        create_v_tunnel(terrain, y1, y2, x1)
+        create_h_tunnel(terrain, x1, x2, y2)
+
+
+def room_start(rooms):
+    # the player starts at the center of the first room
+    (x, y) = rooms[0].center()
+    return (int(x), int(y))
+
+
+def floor_regions(terrain):
+    # cut the map into room-sized blocks and return the ones with some floor in
+    # them, so objects can be placed on maps that have no real rooms
+    regions = []
+    for y in range(0, MAP_HEIGHT, ROOM_MAX_SIZE):
+        h = min(ROOM_MAX_SIZE, MAP_HEIGHT - y)
+        for x in range(0, MAP_WIDTH, ROOM_MAX_SIZE):
+            w = min(ROOM_MAX_SIZE, MAP_WIDTH - x)
+            for row in range(y, y + h):
+                if 0 in terrain[row * MAP_WIDTH + x:row * MAP_WIDTH + x + w]:
+                    # the room's walls are one tile outside the block
+                    regions.append(Rect(x - 1, y - 1, w + 1, h + 1))
+                    break
+    return regions
+
+
+def random_floor(terrain):
+    # a random floor tile, to start the player on maps that have no rooms
+    floor = [i for i in range(len(terrain)) if terrain[i] == 0]
+    i = floor[libtcod.random_get_int(rng, 0, len(floor) - 1)]
+    return (i % MAP_WIDTH, i // MAP_WIDTH)
+
+
+def generate_rooms(terrain):
+    # random rooms that don't overlap, each joined to the previous one by a tunnel
     rooms = []
-    num_rooms = 0
 
     for r in range(MAX_ROOMS):
         # random width and height
-        w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        w = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        h = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
         # random position without going out of the boundaries of the map
-        x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = libtcod.random_get_int(rng, 0, MAP_WIDTH - w - 1)
+        y = libtcod.random_get_int(rng, 0, MAP_HEIGHT - h - 1)
 
         # "Rect" class makes rectangles easier to work with
         new_room = Rect(x, y, w, h)
@@ -527,55 +992,210 @@ def make_map():
             # this means there are no intersections, so this room is valid
 
             # "paint" it to the map's tiles
-            create_room(new_room)
+            create_room(terrain, new_room)
 
-            # center coordinates of new room, will be useful later
-            (new_x, new_y) = new_room.center()
+            if rooms:
+                # all rooms after the first:
+                # connect it to the previous room with a tunnel
+                connect_rooms(terrain, rooms[-1], new_room)
 
-            # optional: print "room number" to see how the map drawing worked
-            #          we may have more than ten rooms, so print 'A' for the first room, 'B' for the next...
-            # room_no = Object(int(new_x), int(new_y), chr(65+num_rooms), libtcod.white)
-            # objects.insert(0, room_no) #draw early, so monsters are drawn on top
+            # finally, append the new room to the list
+            rooms.append(new_room)
 
-            if num_rooms == 0:
-                # this is the first room, where the player starts at
-                player.x = int(new_x)
-                player.y = int(new_y)
+    return (rooms, room_start(rooms))
+
+
+def bsp_split(terrain, x, y, w, h, rooms):
+    # split the area in two and recurse, until it's too small: then put a room in
+    # it. returns a room inside the area, so the caller can join the two halves
+    min_size = ROOM_MIN_SIZE + 2
+
+    if w >= 2 * min_size and (w >= h or h < 2 * min_size):
+        cut = libtcod.random_get_int(rng, x + min_size, x + w - min_size)
+        room = bsp_split(terrain, x, y, cut - x, h, rooms)
+        other_room = bsp_split(terrain, cut, y, x + w - cut, h, rooms)
+        connect_rooms(terrain, room, other_room)
+        return room
+
+    if h >= 2 * min_size:
+        cut = libtcod.random_get_int(rng, y + min_size, y + h - min_size)
+        room = bsp_split(terrain, x, y, w, cut - y, rooms)
+        other_room = bsp_split(terrain, x, cut, w, y + h - cut, rooms)
+        connect_rooms(terrain, room, other_room)
+        return room
+
+    # a leaf: a random room that fits inside it
+    room_w = libtcod.random_get_int(rng, ROOM_MIN_SIZE, min(ROOM_MAX_SIZE, w - 1))
+    room_h = libtcod.random_get_int(rng, ROOM_MIN_SIZE, min(ROOM_MAX_SIZE, h - 1))
+    room = Rect(
+        libtcod.random_get_int(rng, x, x + w - 1 - room_w),
+        libtcod.random_get_int(rng, y, y + h - 1 - room_h),
+        room_w,
+        room_h,
+    )
+    create_room(terrain, room)
+    rooms.append(room)
+    return room
 
-            else:
-                # all rooms after the first:
-                # connect it to the previous room with a tunnel
 
-                # center coordinates of previous room
-                (prev_x, prev_y) = rooms[num_rooms - 1].center()
+def generate_bsp(terrain):
+    # binary space partitioning: every part of the map gets a room, and rooms
+    # that were split apart get joined again
+    rooms = []
+    bsp_split(terrain, 0, 0, MAP_WIDTH, MAP_HEIGHT, rooms)
+    return (rooms, room_start(rooms))
+
+
+def keep_largest_cave(terrain):
+    # fill every floor area but the biggest one, so the whole map is reachable
+    seen = bytearray(len(terrain))
+    largest = []
+    for i in range(len(terrain)):
+        if terrain[i] == 0 and not seen[i]:
+            seen[i] = 1
+            area = [i]
+            queue = deque(area)
+            while queue:
+                j = queue.popleft()
+                for k in (j - 1, j + 1, j - MAP_WIDTH, j + MAP_WIDTH):
+                    if terrain[k] == 0 and not seen[k]:
+                        seen[k] = 1
+                        area.append(k)
+                        queue.append(k)
+
+            if len(area) > len(largest):
+                (area, largest) = (largest, area)
+            for j in area:
+                terrain[j] = 1
+
+
+def generate_caves(terrain):
+    # cellular automata: start from random noise, then repeatedly turn each cell
+    # into a wall if most of the 3x3 block around it are walls
+    for i in range(MAP_WIDTH + 1, len(terrain) - MAP_WIDTH - 1):
+        if libtcod.random_get_int(rng, 0, 99) >= CAVE_WALL_CHANCE:
+            terrain[i] = 0
+
+    for step in range(CAVE_SMOOTHING_STEPS):
+        # walls are bordered, so the map edges stay walls
+        terrain[0:MAP_WIDTH] = b"\x01" * MAP_WIDTH
+        terrain[len(terrain) - MAP_WIDTH:] = b"\x01" * MAP_WIDTH
+        terrain[0::MAP_WIDTH] = b"\x01" * MAP_HEIGHT
+        terrain[MAP_WIDTH - 1::MAP_WIDTH] = b"\x01" * MAP_HEIGHT
+
+        # count the walls in every 3x3 block as a box filter split in two passes:
+        # sums of 3 along the rows, then sums of 3 of those down the columns.
+        # horizontal[i] is centered on cell i + 1, box[i] on cell i + MAP_WIDTH + 1
+        horizontal = [a + b + c for a, b, c in zip(terrain, terrain[1:], terrain[2:])]
+        box = [
+            a + b + c
+            for a, b, c in zip(horizontal, horizontal[MAP_WIDTH:], horizontal[2 * MAP_WIDTH:])
+        ]
+        terrain[MAP_WIDTH + 1:MAP_WIDTH + 1 + len(box)] = bytes(
+            1 if walls >= 5 else 0 for walls in box
+        )
 
-                # draw a coin (random number that is either 0 or 1)
-                if libtcod.random_get_int(0, 0, 1) == 1:
-                    # first move horizontally, then vertically
-                    create_h_tunnel(prev_x, new_x, prev_y)
-                    create_v_tunnel(prev_y, new_y, new_x)
-                else:
-                    # first move vertically, then horizontally
-                    create_v_tunnel(prev_y, new_y, prev_x)
-                    create_h_tunnel(prev_x, new_x, new_y)
+    terrain[0::MAP_WIDTH] = b"\x01" * MAP_HEIGHT
+    terrain[MAP_WIDTH - 1::MAP_WIDTH] = b"\x01" * MAP_HEIGHT
+    keep_largest_cave(terrain)
+    return (floor_regions(terrain), random_floor(terrain))
+
+
+def generate_drunkard(terrain):
+    # drunkard's walk: stumble around from the center, digging, until enough of
+    # the map is floor. everything dug is connected by construction
+    x = MAP_WIDTH // 2
+    y = MAP_HEIGHT // 2
+    wanted = (MAP_WIDTH - 2) * (MAP_HEIGHT - 2) * DRUNKARD_FLOOR_PERCENT // 100
+    dug = 0
+    while dug < wanted:
+        if terrain[y * MAP_WIDTH + x]:
+            terrain[y * MAP_WIDTH + x] = 0
+            dug += 1
+
+        direction = libtcod.random_get_int(rng, 0, 3)
+        if direction == 0 and x > 1:
+            x -= 1
+        elif direction == 1 and x < MAP_WIDTH - 2:
+            x += 1
+        elif direction == 2 and y > 1:
+            y -= 1
+        elif direction == 3 and y < MAP_HEIGHT - 2:
+            y += 1
+
+    return (floor_regions(terrain), (MAP_WIDTH // 2, MAP_HEIGHT // 2))
+
+
+# every way of generating a map. a generator digs floor (0) into the terrain, which
+# starts as all walls (1), one byte per tile, row by row. it returns the rooms to
+# place objects in, and where the player starts
+MAP_GENERATORS = {
+    "rooms": generate_rooms,
+    "bsp": generate_bsp,
+    "caves": generate_caves,
+    "drunkard": generate_drunkard,
+}
 
-            # finally, append the new room to the list
-            place_objects(new_room)
-            rooms.append(new_room)
-            num_rooms += 1
+
+def make_map():
+    global map, objects
+
+    #the list of objects with just the player
+    objects = [player]
+
+    # dig the map out of solid rock
+    terrain = bytearray(b"\x01") * (MAP_WIDTH * MAP_HEIGHT)
+    (rooms, (player.x, player.y)) = MAP_GENERATORS[map_generator](terrain)
+
+    close_map()
+    map = create_map(map_file, terrain, libtcod.random_get_int(0, 0, 0x7FFFFFFF))
+
+    occupied = set([(player.x, player.y)])
+    for room in rooms:
+        place_objects(room, occupied)
+
+
+def set_map_size(map_width, map_height):
+    # generate maps of another size, scaling the number of rooms with the area
+    global MAP_WIDTH, MAP_HEIGHT, MAX_ROOMS
+
+    MAX_ROOMS = max(1, MAX_ROOMS * map_width * map_height // (MAP_WIDTH * MAP_HEIGHT))
+    MAP_WIDTH = map_width
+    MAP_HEIGHT = map_height
+
+
+def benchmark_map_generators(map_width, map_height, runs, seed=None):
+    # time every map generator on its own, on maps of the given size
+    global rng
+
+    set_map_size(map_width, map_height)
+    rng = libtcod.random_new_from_seed(0 if seed is None else seed)
+
+    for name, generator in MAP_GENERATORS.items():
+        start = time.perf_counter()
+        for i in range(runs):
+            generator(bytearray(b"\x01") * (MAP_WIDTH * MAP_HEIGHT))
+        elapsed = time.perf_counter() - start
+        print("%-10s %9.3f ms per %dx%d map" % (name, elapsed * 1000.0 / runs, MAP_WIDTH, MAP_HEIGHT))
 
 
 def handle_keys():
     global playerx, playery, fov_recompute
 
-    key = libtcod.console_wait_for_keypress(True)
+    key = wait_for_keypress()
 
     if key.vk == libtcod.KEY_ENTER and key.lalt:  #(special case) Alt+Enter: toggle fullscreen
-        libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
+        if not headless:
+            libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
 
     elif key.vk == libtcod.KEY_ESCAPE:
         return "exit"
 
+    elif chr(key.c) == "u":
+        # undo the last turn, even the one the player died in
+        rewind()
+        return "didnt-take-turn"
+
     # movement keys
     if game_state == "playing":
         if key.vk == libtcod.KEY_UP:
@@ -620,12 +1240,146 @@ def handle_keys():
                         object.item.pick_up()
                         break
 
+            elif key_char == "x":
+                # explore until something shows up
+                return auto_explore()
+
+            elif key_char == "t":
+                # travel to the tile under the mouse
+                (x, y) = travel_target()
+                return travel_to(x, y)
+
             return "didnt-take-turn"
 
 
+def find_path(goal):
+    # breadth-first search over the explored floor, from the player to the closest
+    # tile for which goal(x, y) is true. returns the steps to take, last one first
+    start = (player.x, player.y)
+    came_from = {start: None}
+    queue = deque([start])
+    while queue:
+        (x, y) = queue.popleft()
+        if (x, y) != start and goal(x, y):
+            path = []
+            while (x, y) != start:
+                path.append((x, y))
+                (x, y) = came_from[(x, y)]
+            return path
+
+        for (nx, ny) in ((x, y - 1), (x, y + 1), (x - 1, y), (x + 1, y)):
+            if (nx, ny) not in came_from and map.explored[nx, ny] and not map.blocked[nx, ny]:
+                came_from[(nx, ny)] = (x, y)
+                queue.append((nx, ny))
+    return None
+
+
+def is_frontier(x, y):
+    # an explored floor tile next to one that isn't explored yet
+    for (nx, ny) in ((x, y - 1), (x, y + 1), (x - 1, y), (x + 1, y)):
+        if not map.explored[nx, ny]:
+            return True
+    return False
+
+
+def monster_in_view():
+    for object in objects:
+        if object.fighter and object is not player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
+            return True
+    return False
+
+
+def items_in_view():
+    return set(
+        object for object in objects
+        if object.item and libtcod.map_is_in_fov(fov_map, object.x, object.y)
+    )
+
+
+def run_batch(next_step):
+    # take many turns in a tight loop, without rendering, until something worth the
+    # player's attention shows up: a monster, an item not seen before, or getting
+    # hurt. next_step() gives the next (dx, dy), or None once there's nowhere to go
+    stop_prefetch()  # the world is about to change
+    seen_items = items_in_view()
+    hp = player.fighter.hp
+
+    for i in range(MAX_BATCH_TURNS):
+        step = next_step()
+        if step is None:
+            break
+
+        # bumping into something takes a turn too, so the monsters get theirs
+        (x, y) = (player.x, player.y)
+        player_move_or_attack(*step)
+        monsters_take_turn()
+        compute_fov()
+        if (player.x, player.y) == (x, y):
+            break  # something was in the way
+        if (game_state != "playing" or player.fighter.hp < hp or monster_in_view()
+                or items_in_view() - seen_items):
+            break
+
+
+class ExploreSteps:
+    # the steps to the closest unexplored place, looked for again once it's explored
+    def __init__(self):
+        self.path = []
+
+    def __call__(self):
+        if not self.path or not is_frontier(*self.path[0]):
+            self.path = find_path(is_frontier)
+            if not self.path:
+                return None
+
+        (x, y) = self.path.pop()
+        return (x - player.x, y - player.y)
+
+
+class TravelSteps:
+    # the steps of a path worked out once
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self):
+        if not self.path:
+            return None
+
+        (x, y) = self.path.pop()
+        return (x - player.x, y - player.y)
+
+
+def auto_explore():
+    if monster_in_view():
+        message("Not with enemies in sight!", libtcod.red)
+        return "didnt-take-turn"
+    if find_path(is_frontier) is None:
+        message("There is nothing left to explore.")
+        return "didnt-take-turn"
+
+    run_batch(ExploreSteps())
+    return "auto-moved"
+
+
+def travel_to(x, y):
+    if monster_in_view():
+        message("Not with enemies in sight!", libtcod.red)
+        return "didnt-take-turn"
+    if not (0 <= x < MAP_WIDTH and 0 <= y < MAP_HEIGHT) or (x, y) == (player.x, player.y):
+        return "didnt-take-turn"
+
+    path = find_path(lambda tx, ty: (tx, ty) == (x, y))
+    if path is None:
+        message("You don't know the way there.", libtcod.red)
+        return "didnt-take-turn"
+
+    run_batch(TravelSteps(path))
+    return "auto-moved"
+
+
 def is_blocked(x, y):
     # first test the map tile
-    if map[x][y].blocked:
+    if map.blocked[x, y]:
         return True
 
     # now check for any blocking objects
@@ -636,7 +1390,7 @@ def is_blocked(x, y):
 
 
 def player_move_or_attack(dx, dy):
-    global fov_recompute
+    global fov_recompute, last_move
 
     # the coordinates the player is moving to/attacking
     x = player.x + dx
@@ -656,98 +1410,307 @@ def player_move_or_attack(dx, dy):
         player.move(dx, dy)
         fov_recompute = True
 
+    last_move = (dx, dy)
+
 
 #### MAP
 
 
-class Tile:
-    # a tile of the map and its properties
-    def __init__(self, blocked, block_sight=None):
-        self.blocked = blocked
+# the map is a few layers of bits, one bit per tile, stored row by row in a memory-mapped
+# file. only the pages of the map that are looked at get loaded, tiles marked explored
+# go straight to the file, and saving the map is just flushing it.
+
+BIT_CHARS = bytes.maketrans(b"\x00\x01", b"01")
+
+
+def pack_bits(cells):
+    # one byte per tile, 0 or 1, to one bit per tile. tile i goes to bit i % 8 of byte i // 8
+    bits = cells.translate(BIT_CHARS)[::-1]
+    return int(bits, 2).to_bytes((len(cells) + 7) // 8, "little")
+
+
+class BitLayer:
+    # one bit per tile of the map, read and written as layer[x, y]
+    def __init__(self, buffer, offset, width):
+        self.buffer = buffer
+        self.offset = offset
+        self.width = width
+
+    def __getitem__(self, position):
+        (x, y) = position
+        i = y * self.width + x
+        return self.buffer[self.offset + (i >> 3)] & (1 << (i & 7)) != 0
 
-        # by default, if a tile is blocked, it also blocks sight
-        if block_sight is None:
-            block_sight = blocked
-        self.block_sight = block_sight
-        self.explored = False
+    def __setitem__(self, position, value):
+        if journal is not None:
+            journal.append((self, position, self[position]))
+        self.write(position, value)
+
+    def write(self, position, value):
+        # set a bit, without journaling it
+        (x, y) = position
+        i = y * self.width + x
+        byte = self.offset + (i >> 3)
+        if value:
+            self.buffer[byte] |= 1 << (i & 7)
+        else:
+            self.buffer[byte] &= ~(1 << (i & 7)) & 0xFF
+
+
+class DungeonMap:
+    # the layers of the map: what blocks movement, what blocks sight and what the
+    # player has seen
+    def __init__(self, buffer, filename=None):
+        (magic, self.width, self.height, self.game_id) = MAP_HEADER.unpack_from(buffer, 0)
+        if magic != MAP_FILE_MAGIC:
+            raise ValueError("not a map file")
+
+        self.buffer = buffer
+        self.filename = filename
+        layer_size = (self.width * self.height + 7) // 8
+        self.blocked = BitLayer(buffer, MAP_HEADER.size, self.width)
+        self.block_sight = BitLayer(buffer, MAP_HEADER.size + layer_size, self.width)
+        self.explored = BitLayer(buffer, MAP_HEADER.size + 2 * layer_size, self.width)
+
+    def flush(self):
+        self.buffer.flush()
+
+    def close(self):
+        self.buffer.close()
+
+    def move_to(self, filename):
+        # a file can't be renamed while it's mapped on Windows: let go of it meanwhile
+        self.buffer.close()
+        os.replace(self.filename, filename)
+        with open(filename, "r+b") as file:
+            self.buffer = mmap.mmap(file.fileno(), 0)
+        for layer in (self.blocked, self.block_sight, self.explored):
+            layer.buffer = self.buffer
+        self.filename = filename
+
+
+def close_map():
+    # let go of the current map. one that was never saved isn't needed anymore
+    global map
+    if map is not None:
+        map.close()
+        if map.filename == MAP_SCRATCH_FILE:
+            os.remove(MAP_SCRATCH_FILE)
+        map = None
+
+
+def create_map(filename, terrain, game_id):
+    # a new map from the generated terrain, with nothing explored yet. a wall blocks
+    # both movement and sight. without a file name the map is kept only in memory
+    blocked = pack_bits(terrain)
+    data = b"".join([
+        MAP_HEADER.pack(MAP_FILE_MAGIC, MAP_WIDTH, MAP_HEIGHT, game_id),
+        blocked, blocked, bytes(len(blocked)),
+    ])
+
+    if filename is None:
+        buffer = mmap.mmap(-1, len(data))
+        buffer[:] = data
+        return DungeonMap(buffer)
+
+    with open(filename, "wb") as file:
+        file.write(data)
+    return open_map(filename)
+
+
+def open_map(filename):
+    with open(filename, "r+b") as file:
+        # the mapping keeps its own handle on the file
+        return DungeonMap(mmap.mmap(file.fileno(), 0), filename)
+
+
+def compute_fov():
+    global fov_recompute, fov_map, prefetched_fov
+
+    if fov_recompute:
+        # recompute FOV if needed (the player moved or something)
+        fov_recompute = False
+        if prefetched_fov is not None and prefetched_fov[0] == (player.x, player.y):
+            # it was already computed while waiting for the player's key
+            fov_map = prefetched_fov[1]
+        else:
+            libtcod.map_compute_fov(
+                fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO
+            )
+
+        # everything the player can see now is explored
+        for y in range(max(player.y - TORCH_RADIUS, 0), min(player.y + TORCH_RADIUS + 1, MAP_HEIGHT)):
+            for x in range(max(player.x - TORCH_RADIUS, 0), min(player.x + TORCH_RADIUS + 1, MAP_WIDTH)):
+                if not map.explored[x, y] and libtcod.map_is_in_fov(fov_map, x, y):
+                    map.explored[x, y] = True
+    prefetched_fov = None
+
+
+def draw_objects():
+    global drawn_glyphs
+
+    # sort the objects in the player's FOV into their render layers
+    layers = [[] for i in range(NUM_LAYERS)]
+    for object in objects:
+        if libtcod.map_is_in_fov(fov_map, object.x, object.y):
+            layers[object.layer].append(object)
+
+    # keep only the top glyph of each tile, higher layers overwrite lower ones
+    glyphs = {}
+    for layer in layers:
+        for object in layer:
+            glyphs[(object.x, object.y)] = (object.char, object.color)
+
+    # erase what was drawn last frame and isn't there anymore, then put each glyph
+    # that wasn't there already
+    for (x, y) in drawn_glyphs:
+        if (x, y) not in glyphs:
+            libtcod.console_set_char(con, x, y, " ")
+            mark_changed(x, y)
+    for (x, y), (char, color) in glyphs.items():
+        if drawn_glyphs.get((x, y)) != (char, color):
+            libtcod.console_set_char(con, x, y, char)
+            libtcod.console_set_char_foreground(con, x, y, color)
+            mark_changed(x, y)
+    drawn_glyphs = glyphs
+
+
+def mark_changed(x, y):
+    # a cell of con was drawn: the spectators will get it with the next frame
+    if changed_cells is not None:
+        changed_cells.add((x, y))
+
+
+def cast_light(light, x, y, radius, intensity, fov):
+    # add a light at (x, y) to the light map, on the tiles it can see (according
+    # to the given FOV map, already computed from there)
+    for ly in range(max(y - radius, 0), min(y + radius + 1, MAP_HEIGHT)):
+        for lx in range(max(x - radius, 0), min(x + radius + 1, MAP_WIDTH)):
+            if libtcod.map_is_in_fov(fov, lx, ly):
+                distance = math.sqrt((lx - x) ** 2 + (ly - y) ** 2)
+                if distance <= radius:
+                    i = ly * MAP_WIDTH + lx
+                    falloff = 1.0 - (distance / (radius + 1)) ** 2
+                    light[i] = min(1.0, light[i] + intensity * falloff)
+
+
+def cast_point_light(light, x, y, radius, intensity):
+    libtcod.map_compute_fov(light_fov_map, x, y, radius, FOV_LIGHT_WALLS, FOV_ALGO)
+    cast_light(light, x, y, radius, intensity, light_fov_map)
+
+
+def compute_lighting():
+    # blend every light into one light map. lights that don't move are cached until
+    # the map revision changes; the player's torch reuses the player's FOV, and only
+    # the moving lights and spell flashes are cast again
+    global static_light, light_map, light_key
+
+    if static_light is None or static_light[0] != map_revision:
+        light = [0.0] * (MAP_WIDTH * MAP_HEIGHT)
+        for object in objects:
+            if object.light and not object.ai and object is not player:
+                cast_point_light(light, object.x, object.y, object.light.radius, object.light.intensity)
+        static_light = (map_revision, light)
+
+    moving = [
+        (object.x, object.y, object.light.radius, object.light.intensity)
+        for object in objects
+        if object.light and object.ai
+    ]
+    moving += [(x, y, radius, 1.0) for (x, y, radius, frames) in flashes]
+
+    key = (map_revision, player.x, player.y, tuple(moving))
+    if key == light_key:
+        return
+    light_key = key
+
+    light = list(static_light[1])
+    cast_light(light, player.x, player.y, TORCH_RADIUS, 1.0, fov_map)
+    for (x, y, radius, intensity) in moving:
+        cast_point_light(light, x, y, radius, intensity)
+    light_map = light
+
+
+def fade_flashes():
+    # spell flashes only last a few frames
+    flashes[:] = [flash for flash in flashes if flash[3] > 1]
+    for flash in flashes:
+        flash[3] -= 1
 
 
 def render_all():
-    global color_light_wall
-    global color_light_ground
-    global fov_recompute
-    global game_msgs
+    global game_msgs, drawn_panel, panel_changed
 
     # go through all tiles, and set their background color according to the FOV
     for y in range(MAP_HEIGHT):
         for x in range(MAP_WIDTH):
             visible = libtcod.map_is_in_fov(fov_map, x, y)
-            wall = map[x][y].block_sight
+            wall = map.block_sight[x, y]
             if not visible:
 
                 # if it's not visible right now, the player can only see it if it's explored
-                if map[x][y].explored:
-                    # it's out of the player's FOV
-                    if wall:
-                        libtcod.console_set_char_background(
-                            con, x, y, color_dark_wall, libtcod.BKGND_SET
-                        )
-                    else:
-                        libtcod.console_set_char_background(
-                            con, x, y, color_dark_ground, libtcod.BKGND_SET
-                        )
+                if not map.explored[x, y]:
+                    continue
+                # it's out of the player's FOV
+                color = color_dark_wall if wall else color_dark_ground
             else:
-                # it's visible
-                if wall:
-                    libtcod.console_set_char_background(
-                        con, x, y, color_light_wall, libtcod.BKGND_SET
-                    )
-                else:
-                    libtcod.console_set_char_background(
-                        con, x, y, color_light_ground, libtcod.BKGND_SET
-                    )
-
-                map[x][y].explored = True
-
-    # draw all objects in the list
-    for object in objects:
-        object.draw()
-    player.draw()
+                # it's visible, and as bright as the light that reaches it
+                level = int(light_map[y * MAP_WIDTH + x] * (LIGHT_LEVELS - 1))
+                color = wall_light_ramp[level] if wall else ground_light_ramp[level]
 
-    # blit the contents of "con" to the root console
-    libtcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
+            # the colors all come from the ramps, so a tile that looks the same as in
+            # the last frame has the very same color object, and is left alone
+            i = y * MAP_WIDTH + x
+            if tile_colors[i] is not color:
+                tile_colors[i] = color
+                libtcod.console_set_char_background(con, x, y, color, libtcod.BKGND_SET)
+                mark_changed(x, y)
 
-    if fov_recompute:
-        # recompute FOV if needed (the player moved or something)
-        fov_recompute = False
-        libtcod.map_compute_fov(
-            fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO
-        )
+    draw_objects()
 
-    # prepare to render the GUI panel
-    libtcod.console_set_default_background(panel, libtcod.black)
-    libtcod.console_clear(panel)
+    # blit the contents of "con" to the root console
+    libtcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
 
-    # print the game messages, one line at a time
-    y = 1
-    for (line, color) in game_msgs:
-        libtcod.console_set_default_foreground(panel, color)
-        libtcod.console_print_ex(
-            panel, MSG_X, y, libtcod.BKGND_NONE, libtcod.LEFT, line
+    compute_fov()
+    compute_lighting()
+
+    # turn the log into lines of text, split as needed, and keep the last ones that fit
+    lines = []
+    for entry in game_msgs:
+        (text, color) = entry.describe()
+        lines += [(line, color) for line in textwrap.wrap(text, MSG_WIDTH)]
+    lines = lines[-MSG_HEIGHT:]
+
+    # the panel is only drawn again when what it shows has changed
+    panel_state = (lines, player.fighter.hp, player.fighter.max_hp)
+    if panel_state != drawn_panel:
+        drawn_panel = panel_state
+        panel_changed = True
+
+        # prepare to render the GUI panel
+        libtcod.console_set_default_background(panel, libtcod.black)
+        libtcod.console_clear(panel)
+
+        # print the game messages, one line at a time
+        y = 1
+        for (line, color) in lines:
+            libtcod.console_set_default_foreground(panel, color)
+            libtcod.console_print_ex(
+                panel, MSG_X, y, libtcod.BKGND_NONE, libtcod.LEFT, line
+            )
+            y += 1
+
+        # show the player's stats
+        render_bar(
+            1,
+            1,
+            BAR_WIDTH,
+            "HP",
+            player.fighter.hp,
+            player.fighter.max_hp,
+            libtcod.light_red,
+            libtcod.darker_red,
         )
-        y += 1
-
-    # show the player's stats
-    render_bar(
-        1,
-        1,
-        BAR_WIDTH,
-        "HP",
-        player.fighter.hp,
-        player.fighter.max_hp,
-        libtcod.light_red,
-        libtcod.darker_red,
-    )
 
     # blit the contents of "panel" to the root console
     libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
@@ -787,11 +1750,11 @@ def menu(header, options, width):
     # blit the contents of "window" to the root console
     x = int(SCREEN_WIDTH / 2) - int(width / 2)
     y = int(SCREEN_HEIGHT / 2) - int(height / 2)
-    libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7)
-
     # present the root console to the player and wait for a key-press
-    libtcod.console_flush()
-    key = libtcod.console_wait_for_keypress(True)
+    if not headless:
+        libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7)
+        libtcod.console_flush()
+    key = wait_for_keypress()
 
     # convert the ASCII code to an index; if it corresponds to an option, return it
     index = key.c - ord("a")
@@ -817,7 +1780,7 @@ def inventory_menu(header):
 def msgbox(text, width=50):
     menu(text, [], width)  #use menu() as a sort of "message box"
 
-def main_menu():
+def main_menu(record_file=None):
     img = libtcod.image_load('menu_background.png')
 
     while not libtcod.console_is_window_closed():
@@ -830,7 +1793,10 @@ def main_menu():
 
         if choice == 0:  #new game
             new_game()
+            if record_file is not None:
+                start_recording(record_file)
             play_game()
+            stop_recording()
 
         elif choice == 1:  #load last game
             try:
@@ -843,12 +1809,20 @@ def main_menu():
         elif choice == 2:  #quit
             break
 
-def new_game():
-    global player, inventory, game_msgs, game_state
+def new_game(seed=None):
+    global player, inventory, game_msgs, game_state, game_seed, rng
+
+    #every random number in the game comes from this generator, so the seed (and
+    #the keys pressed) are enough to play the same game again
+    if seed is None:
+        seed = libtcod.random_get_int(0, 0, 0x7FFFFFFF)
+    game_seed = seed
+    rng = libtcod.random_new_from_seed(seed)
 
     #create object representing the player
     fighter_component = Fighter(hp=30, defense=2, power=5, death_function=player_death)
-    player = Object(0, 0, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component)
+    player = Object(0, 0, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component,
+                    layer=LAYER_PLAYER)
 
     #generate map (at this point it's not drawn to the screen)
     make_map()
@@ -865,73 +1839,617 @@ def new_game():
 
 
 def save_game():
-    #open a new empty shelve (possibly overwriting an old one) to write the game data
-    file = shelve.open('savegame', 'n')
-    file['map'] = map
-    file['objects'] = objects
-    file['player_index'] = objects.index(player)  #index of player in objects list
-    file['inventory'] = inventory
-    file['game_msgs'] = game_msgs
-    file['game_state'] = game_state
-    file.close()
+    # the map is already in its own file: it only needs a name no other save uses, so
+    # the old save keeps its map until the new save has replaced it
+    map.flush()
+    map_name = map.filename
+    while os.path.exists(map_name):
+        map_name = MAP_FILE % libtcod.random_get_int(0, 0, 0x7FFFFFFF)
+    map.move_to(map_name)
+
+    #write the game data next to the old save, then swap it in with a single rename
+    with open(SAVE_SCRATCH_FILE, 'wb') as file:
+        pickle.dump({
+            'map_file': map_name,
+            'map_id': map.game_id,
+            'objects': objects,
+            'player_index': objects.index(player),  #index of player in objects list
+            'inventory': inventory,
+            'game_msgs': game_msgs,
+            'game_state': game_state,
+        }, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(SAVE_SCRATCH_FILE, SAVE_FILE)
+
+    # the maps of older saves aren't needed anymore
+    for name in glob.glob(MAP_FILES):
+        if name != map_name:
+            os.remove(name)
 
 def load_game():
-    #open the previously saved shelve and load the game data
-    global map, objects, player, inventory, game_msgs, game_state
-
-    file = shelve.open('savegame', 'r')
-    map = file['map']
-    objects = file['objects']
-    player = objects[file['player_index']]  #get index of player in objects list and access it
-    inventory = file['inventory']
-    game_msgs = file['game_msgs']
-    game_state = file['game_state']
-    file.close()
+    #open the previously saved game and load the game data
+    global map, objects, player, inventory, game_msgs, game_state, game_seed, rng
+
+    with open(SAVE_FILE, 'rb') as file:
+        save = pickle.load(file)
+
+    # make sure the map belongs to the save before letting go of the current game
+    saved_map = open_map(save['map_file'])
+    game_id = saved_map.game_id
+    saved_map.close()
+    if game_id != save['map_id']:
+        raise ValueError("the map file belongs to another game")
+
+    # play on a copy of the map: the save only changes when the game is saved again
+    close_map()
+    shutil.copyfile(save['map_file'], MAP_SCRATCH_FILE)
+    map = open_map(MAP_SCRATCH_FILE)
+
+    objects = save['objects']
+    player = objects[save['player_index']]  #get index of player in objects list and access it
+    inventory = save['inventory']
+    game_msgs = save['game_msgs']
+    game_state = save['game_state']
+
+    rng = libtcod.random_new()
+    game_seed = None  # the game goes on from where it was, not from a seed
 
     initialize_fov()
 
 def initialize_fov():
-    global fov_recompute, fov_map
+    global fov_recompute, fov_map, drawn_glyphs, tile_colors, drawn_panel, changed_cells
+    global light_fov_map, static_light, light_key, light_map, flashes
     fov_recompute = True
 
     libtcod.console_clear(con)  #unexplored areas start black (which is the default background color)
+    drawn_glyphs = {}
+    tile_colors = [None] * (MAP_WIDTH * MAP_HEIGHT)  # the background drawn on each tile
+    drawn_panel = None
+    changed_cells = None  # the spectators need the whole new screen
 
     #create the FOV map, according to the generated map
     fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
     for y in range(MAP_HEIGHT):
         for x in range(MAP_WIDTH):
-            libtcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+            libtcod.map_set_properties(fov_map, x, y, not map.block_sight[x, y], not map.blocked[x, y])
+
+    #lights other than the player's torch see the map through a copy of it
+    light_fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
+    libtcod.map_copy(fov_map, light_fov_map)
+    static_light = None
+    light_key = None
+    light_map = [0.0] * (MAP_WIDTH * MAP_HEIGHT)
+    flashes = []
 
 
 def play_game():
-    global key, mouse
+    global key, mouse, prefetched_fov
 
     player_action = None
+    turns = 0
+    reset_snapshots()
 
     mouse = libtcod.Mouse()
     key = libtcod.Key()
-    while not libtcod.console_is_window_closed():
-        #render the screen
-        libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse)
-        render_all()
+    try:
+        while not libtcod.console_is_window_closed():
+            #render the screen
+            libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse)
+            render_all()
+
+            libtcod.console_flush()
+            publish_frame()
+            fade_flashes()
+
+            #get the next turn ready while the player thinks
+            start_prefetch()
+
+            #handle keys and exit game if needed
+            snapshot = save_snapshot()
+            player_action = handle_keys()
+            stop_prefetch()
+            if player_action == 'exit':
+                save_game()
+                break
 
-        libtcod.console_flush()
+            #let monsters take their turn
+            if game_state == 'playing' and player_action not in ('didnt-take-turn', 'auto-moved'):
+                monsters_take_turn(prefetch.plans_for(take_snapshot()))
+            prefetched_fov = prefetch.fov_for(player.x, player.y)
+
+            if player_action != 'didnt-take-turn':
+                keep_rewind_point(snapshot)
+                turns += 1
+                if recording is not None and turns % CHECKPOINT_INTERVAL == 0:
+                    recording.record_checkpoint(turns, state_hash())
+    finally:
+        # whatever ends the game, the journal mustn't outlive it
+        reset_snapshots()
+
+#### PREFETCH
+
+
+class Prefetch:
+    # while the game waits for a key, a worker thread guesses where the player will
+    # be next (each of the four moves, or staying put) and, for each guess, gets the
+    # monsters' plans and the player's FOV ready. once the key is handled, the guess
+    # that came true is used and the rest thrown away. the worker only reads the
+    # world, and is stopped before the monsters move
+    def __init__(self):
+        self.x = player.x
+        self.y = player.y
+        self.hp = player.fighter.hp
+        self.ais = [object.ai for object in objects if object.ai]
+        self.results = {}  # player position -> (snapshot, plans by AI, FOV map)
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        # the direction the player went last is the most likely one
+        moves = [last_move] + [move for move in PREFETCH_MOVES if move != last_move]
+        for (dx, dy) in moves:
+            if self.cancelled.is_set():
+                return
+            x = self.x + dx
+            y = self.y + dy
+            if (x, y) in self.results or map.blocked[x, y]:
+                continue  # bumping into a wall is the same as staying put
+
+            snapshot = (x, y, self.hp)
+            plans = {}
+            for ai in self.ais:
+                # a busy level has many monsters to plan for: don't keep the key waiting
+                if self.cancelled.is_set():
+                    return
+                plans[ai] = ai.plan_turn(snapshot)
+
+            fov = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
+            libtcod.map_copy(fov_map, fov)
+            libtcod.map_compute_fov(fov, x, y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+            self.results[(x, y)] = (snapshot, plans, fov)
+
+    def stop(self):
+        # drops the guess being worked on, and skips the rest
+        self.cancelled.set()
+        self.thread.join()
+
+    def plans_for(self, snapshot):
+        # the monsters' plans, if they were made for this exact snapshot
+        result = self.results.get(snapshot[:2])
+        if result is not None and result[0] == snapshot:
+            return result[1]
+        return None
+
+    def fov_for(self, x, y):
+        # the FOV from the player's position, ready to be used by compute_fov()
+        result = self.results.get((x, y))
+        if result is not None:
+            return ((x, y), result[2])
+        return None
+
+
+def start_prefetch():
+    global prefetch
+    prefetch = Prefetch()
 
-        #erase all objects at their old locations, before they move
-        for object in objects:
-            object.clear()
 
-        #handle keys and exit game if needed
-        player_action = handle_keys()
-        if player_action == 'exit':
-            save_game()
+def stop_prefetch():
+    # the world is about to change: the worker mustn't be reading it anymore
+    if prefetch is not None:
+        prefetch.stop()
+
+
+#### RECORDING AND REPLAY
+
+
+RecordedKey = namedtuple("RecordedKey", ["vk", "c", "lalt"])
+RecordedTarget = namedtuple("RecordedTarget", ["x", "y"])
+
+
+class Recording:
+    # a game's seed, map generator and every key pressed during it, written to a
+    # compact file: three bytes per key, five per travel target, plus a state hash
+    # every CHECKPOINT_INTERVAL turns
+    def __init__(self, filename, seed, generator):
+        self.file = open(filename, "wb")
+        self.file.write(RECORDING_MAGIC + struct.pack("<IB", seed, len(generator)))
+        self.file.write(generator.encode())
+
+    def record_key(self, key):
+        self.file.write(struct.pack("<BBB", 1 if key.lalt else 0, key.vk, key.c))
+
+    def record_target(self, x, y):
+        self.file.write(struct.pack("<BHH", 0xFE, x, y))
+
+    def record_checkpoint(self, turn, hash):
+        self.file.write(struct.pack("<BII", 0xFF, turn, hash))
+
+    def close(self):
+        self.file.close()
+
+
+def read_recording(filename):
+    # returns the seed, the map generator, the keys pressed (and travel targets picked),
+    # and the state hashes by turn
+    with open(filename, "rb") as file:
+        data = file.read()
+    if data[:len(RECORDING_MAGIC)] != RECORDING_MAGIC:
+        raise ValueError(filename + " is not a recorded game.")
+
+    pos = len(RECORDING_MAGIC)
+    (seed, length) = struct.unpack_from("<IB", data, pos)
+    pos += 5
+    generator = data[pos:pos + length].decode()
+    pos += length
+
+    keys = []
+    checkpoints = {}
+    while pos < len(data):
+        if data[pos] == 0xFF:
+            (turn, hash) = struct.unpack_from("<II", data, pos + 1)
+            checkpoints[turn] = hash
+            pos += 9
+        elif data[pos] == 0xFE:
+            keys.append(RecordedTarget(*struct.unpack_from("<HH", data, pos + 1)))
+            pos += 5
+        else:
+            (flags, vk, c) = struct.unpack_from("<BBB", data, pos)
+            keys.append(RecordedKey(vk, c, bool(flags & 1)))
+            pos += 3
+    return (seed, generator, keys, checkpoints)
+
+
+def start_recording(filename):
+    global recording
+    recording = Recording(filename, game_seed, map_generator)
+
+
+def stop_recording():
+    global recording
+    if recording is not None:
+        recording.close()
+        recording = None
+
+
+def wait_for_keypress():
+    # the next key, from the game being replayed or from the keyboard
+    if replay_keys is not None:
+        if replay_keys:
+            return replay_keys.popleft()
+        # out of keys: the recorded player is done
+        return RecordedKey(libtcod.KEY_ESCAPE, 0, False)
+
+    key = libtcod.console_wait_for_keypress(True)
+    if recording is not None:
+        recording.record_key(key)
+    return key
+
+
+def travel_target():
+    # the tile the player wants to travel to: the one under the mouse
+    if replay_keys is not None:
+        if replay_keys and isinstance(replay_keys[0], RecordedTarget):
+            return tuple(replay_keys.popleft())
+        return (-1, -1)
+
+    # the mouse was last read before waiting for the key, and may have moved since
+    libtcod.sys_check_for_event(libtcod.EVENT_MOUSE, libtcod.Key(), mouse)
+    (x, y) = (mouse.cx, mouse.cy)
+    if not (0 <= x < MAP_WIDTH and 0 <= y < min(MAP_HEIGHT, PANEL_Y)):
+        return (-1, -1)  # off the map, or over the panel
+    if recording is not None:
+        recording.record_target(x, y)
+    return (x, y)
+
+
+def state_hash():
+    # a hash of what a frame would show, to check that a replay matches the recording
+    state = [
+        (object.x, object.y, object.char, object.fighter.hp if object.fighter else -1)
+        for object in objects
+    ]
+    state.append((game_state, len(inventory)))
+    return zlib.crc32(repr(state).encode())
+
+
+def replay_game(filename):
+    # play a recorded game again, as fast as possible and without rendering
+    global replay_keys, map_generator
+
+    (seed, map_generator, keys, checkpoints) = read_recording(filename)
+    replay_keys = deque(keys)
+    new_game(seed)
+
+    turns = 0
+    mismatches = 0
+    reset_snapshots()
+    start = time.perf_counter()
+    try:
+        while True:
+            compute_fov()
+            snapshot = save_snapshot()
+            player_action = handle_keys()
+            if player_action == 'exit':
+                break
+
+            if game_state == 'playing' and player_action not in ('didnt-take-turn', 'auto-moved'):
+                monsters_take_turn()
+
+            if player_action != 'didnt-take-turn':
+                keep_rewind_point(snapshot)
+                turns += 1
+                if turns in checkpoints and checkpoints[turns] != state_hash():
+                    print("turn %d does not match the recording" % turns)
+                    mismatches += 1
+    finally:
+        reset_snapshots()
+        replay_keys = None
+    elapsed = time.perf_counter() - start
+
+    print("replayed %d keys, %d turns in %.3f s" % (len(keys), turns, elapsed))
+    print("%d of %d checkpoints matched" % (len(checkpoints) - mismatches, len(checkpoints)))
+
+
+#### SPECTATORS
+
+
+class SpectatorServer:
+    # streams the con and panel consoles to viewers connecting on localhost. the
+    # server runs its own asyncio loop on a background thread, so the game only
+    # hands over each frame and never waits on a slow viewer.
+    #
+    # every frame is a header (con width and height, panel width and height, number
+    # of changed cells) followed by the changed cells, each one as its index (con
+    # cells first, then panel cells), character, foreground and background colors
+    def __init__(self, port):
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.viewers = {}  # viewer -> True while it still needs a full frame
+        self.frame = None
+        self.sizes = None
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(
+            asyncio.start_server(self.connected, "127.0.0.1", self.port)
+        )
+        self.loop.run_forever()
+
+    async def connected(self, reader, writer):
+        # a new viewer starts with the whole screen, then gets only the changes
+        self.viewers[writer] = True
+        if self.frame is not None:
+            self.send(writer, self.encode(self.frame))
+        try:
+            await reader.read()  # nothing to read, just wait until the viewer leaves
+        except ConnectionError:
+            pass
+        finally:
+            del self.viewers[writer]
+            writer.close()
+
+    def publish(self, sizes, changes, complete):
+        # called from the game: the rest happens on the server's thread
+        self.loop.call_soon_threadsafe(self.broadcast, sizes, changes, complete)
+
+    def broadcast(self, sizes, changes, complete):
+        # changes has the cells drawn this frame by index, or every cell if complete
+        if complete:
+            self.frame = {}
+            self.sizes = sizes
+        self.frame.update(changes)
+
+        delta = None
+        keyframe = None
+        for writer in self.viewers:
+            if writer.transport.get_write_buffer_size() > SPECTATOR_MAX_BUFFER:
+                # too slow: skip this frame, and send everything once it has caught up
+                self.viewers[writer] = True
+            elif self.viewers[writer]:
+                if keyframe is None:
+                    keyframe = self.encode(self.frame)
+                self.send(writer, keyframe)
+            else:
+                if delta is None:
+                    delta = self.encode(changes)
+                self.send(writer, delta)
+
+    def send(self, writer, data):
+        if not writer.is_closing():
+            writer.write(data)
+            self.viewers[writer] = False
+
+    def encode(self, cells):
+        changes = [
+            struct.pack("<IB", index, char) + fore + back
+            for index, (char, fore, back) in cells.items()
+        ]
+        return struct.pack("<HHHHI", *(self.sizes + (len(changes),))) + b"".join(changes)
+
+
+def capture_cell(console, x, y):
+    # the character and colors of a cell of the console
+    fore = libtcod.console_get_char_foreground(console, x, y)
+    back = libtcod.console_get_char_background(console, x, y)
+    return (
+        libtcod.console_get_char(console, x, y) & 0xFF,
+        bytes((fore.r, fore.g, fore.b)),
+        bytes((back.r, back.g, back.b)),
+    )
+
+
+def publish_frame():
+    # hand the cells drawn in the frame just rendered to the spectators. the render
+    # pass keeps track of them, so a frame where little changed costs little
+    global changed_cells, panel_changed
+    if spectators is None or not spectators.viewers:
+        return  # the changes pile up until somebody watches (at most the whole screen)
+
+    con_width = libtcod.console_get_width(con)
+    con_height = libtcod.console_get_height(con)
+    panel_width = libtcod.console_get_width(panel)
+    panel_height = libtcod.console_get_height(panel)
+
+    complete = changed_cells is None
+    if complete:
+        changed_cells = [(x, y) for y in range(con_height) for x in range(con_width)]
+    changes = {}
+    for (x, y) in changed_cells:
+        changes[y * con_width + x] = capture_cell(con, x, y)
+
+    # the panel cells come after the con cells
+    if complete or panel_changed:
+        start = con_width * con_height
+        for y in range(panel_height):
+            for x in range(panel_width):
+                changes[start + y * panel_width + x] = capture_cell(panel, x, y)
+
+    sizes = (con_width, con_height, panel_width, panel_height)
+    spectators.publish(sizes, changes, complete)
+    changed_cells = set()
+    panel_changed = False
+
+
+#### STRESS TEST
+
+
+def spawn_objects(num_monsters, num_items):
+    # scatter monsters and items over free floor tiles anywhere on the map,
+    # ignoring the per-room limits
+    global map_revision
+    occupied = set((object.x, object.y) for object in objects)
+    free = [
+        (x, y)
+        for x in range(MAP_WIDTH)
+        for y in range(MAP_HEIGHT)
+        if not map.blocked[x, y] and (x, y) not in occupied
+    ]
+
+    for i, (x, y) in enumerate(take_random_tiles(free, num_monsters + num_items)):
+        if i < num_monsters:
+            objects.append(create_monster(x, y))
+        else:
+            objects.append(create_item(x, y))
+    map_revision += 1
+
+
+def stress_player_turn():
+    # a simple automated player: hunt the closest visible monster, or wander around
+    monster = closest_monster(TORCH_RADIUS)
+    if monster is not None:
+        (dx, dy) = player.step_towards(monster.x, monster.y)
+    else:
+        # a step of (0, 0) would be the player attacking itself
+        (dx, dy) = (0, 0)
+        while (dx, dy) == (0, 0):
+            dx = libtcod.random_get_int(rng, -1, 1)
+            dy = libtcod.random_get_int(rng, -1, 1)
+    player_move_or_attack(dx, dy)
+
+
+def stress_test(map_width, map_height, num_monsters, num_items, num_turns, render, seed=None):
+    global con
+
+    set_map_size(map_width, map_height)
+    con = libtcod.console_new(max(MAP_WIDTH, SCREEN_WIDTH), max(MAP_HEIGHT, SCREEN_HEIGHT))
+
+    new_game(seed)
+    spawn_objects(num_monsters, num_items)
+    # the automated player never dies, so every run lasts the same number of turns
+    player.fighter.max_hp = player.fighter.hp = 1000000000
+    monsters_start = len([object for object in objects if object.ai])
+
+    timings = {"player": 0.0, "monsters": 0.0, "fov": 0.0, "render": 0.0}
+    turns = 0
+    start = time.perf_counter()
+    while turns < num_turns:
+        if render and libtcod.console_is_window_closed():
             break
 
-        #let monsters take their turn
-        if game_state == 'playing' and player_action != 'didnt-take-turn':
-            for object in objects:
-                if object.ai:
-                    object.ai.take_turn()
+        t0 = time.perf_counter()
+        stress_player_turn()
+        t1 = time.perf_counter()
+        monsters_take_turn()
+        t2 = time.perf_counter()
+        compute_fov()
+        t3 = time.perf_counter()
+        if render:
+            render_all()
+            libtcod.console_flush()
+            publish_frame()
+        t4 = time.perf_counter()
+
+        timings["player"] += t1 - t0
+        timings["monsters"] += t2 - t1
+        timings["fov"] += t3 - t2
+        timings["render"] += t4 - t3
+        turns += 1
+    elapsed = time.perf_counter() - start
+
+    monsters_left = len([object for object in objects if object.ai])
+    print("map %dx%d, %d monsters (%d left), %d turns%s" % (
+        MAP_WIDTH, MAP_HEIGHT, monsters_start, monsters_left, turns,
+        "" if render else ", no rendering"))
+    print("%.1f turns per second" % (turns / elapsed if elapsed > 0 else 0.0))
+    for phase in ("player", "monsters", "fov", "render"):
+        print("  %-8s %8.3f ms/turn" % (phase, timings[phase] * 1000.0 / max(turns, 1)))
+    if resource is not None:
+        # ru_maxrss is reported in kilobytes on Linux
+        print("peak memory: %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def int_between(low, high=None):
+    # an argparse type for whole numbers from low to high (or up from low)
+    def parse(text):
+        value = int(text)
+        if value < low:
+            raise argparse.ArgumentTypeError("must be at least %d, not %d" % (low, value))
+        if high is not None and value > high:
+            raise argparse.ArgumentTypeError("must be at most %d, not %d" % (high, value))
+        return value
+    return parse
+
+
+# every map has room for at least one room, and its size fits the map file's header
+map_size = int_between(ROOM_MAX_SIZE + 2, 0xFFFF)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="python/libtcod tutorial")
+    parser.add_argument("--stress", action="store_true",
+                        help="run an automated game and report how fast it goes")
+    parser.add_argument("--map-width", type=map_size, default=MAP_WIDTH)
+    parser.add_argument("--map-height", type=map_size, default=MAP_HEIGHT)
+    parser.add_argument("--monsters", type=int_between(0), default=1000,
+                        help="number of monsters to spawn in stress mode")
+    parser.add_argument("--items", type=int_between(0), default=200,
+                        help="number of items to spawn in stress mode")
+    parser.add_argument("--turns", type=int_between(1), default=500,
+                        help="number of turns to play in stress mode")
+    parser.add_argument("--no-render", action="store_true",
+                        help="don't open a window in stress mode")
+    parser.add_argument("--seed", type=int,
+                        help="random seed for stress mode and --bench-mapgen")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record new games (seed and keys pressed) to FILE")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="replay a recorded game without rendering and check it matches")
+    parser.add_argument("--map-generator", choices=sorted(MAP_GENERATORS), default=map_generator,
+                        help="how new maps are generated")
+    parser.add_argument("--bench-mapgen", action="store_true",
+                        help="time every map generator and exit")
+    parser.add_argument("--runs", type=int_between(1), default=20,
+                        help="maps generated per generator by --bench-mapgen")
+    parser.add_argument("--event-log", metavar="FILE",
+                        help="append combat and item events to FILE, as JSON lines")
+    parser.add_argument("--spectate", type=int, metavar="PORT",
+                        help="stream the screen to spectators connecting to localhost:PORT")
+    return parser.parse_args()
+
 
 ### INIT
 
@@ -942,12 +2460,41 @@ message(
     libtcod.red,
 )
 
-libtcod.console_set_custom_font(
-    "arial10x10.png", libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD
-)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, "python/libtcod tutorial", False)
-libtcod.sys_set_fps(LIMIT_FPS)
-con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+args = parse_arguments()
+headless = (args.stress and args.no_render) or args.replay is not None or args.bench_mapgen
+map_generator = args.map_generator
+if args.stress or args.replay is not None:
+    map_file = None  # never saved, so don't write over the saved game's map
 
+if not headless:
+    libtcod.console_set_custom_font(
+        "arial10x10.png", libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD
+    )
+    libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, "python/libtcod tutorial", False)
+    # in stress mode, render as fast as possible
+    libtcod.sys_set_fps(0 if args.stress else LIMIT_FPS)
+con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
 
-main_menu()
+event_log = None
+if args.event_log is not None:
+    event_log = EventLogSink(args.event_log)
+    subscribe(event_log, *EVENT_TYPES)
+
+spectators = None
+if args.spectate is not None and not headless:
+    spectators = SpectatorServer(args.spectate)
+
+
+if args.bench_mapgen:
+    benchmark_map_generators(args.map_width, args.map_height, args.runs, args.seed)
+elif args.replay is not None:
+    replay_game(args.replay)
+elif args.stress:
+    stress_test(args.map_width, args.map_height, args.monsters, args.items, args.turns,
+                not headless, args.seed)
+else:
+    main_menu(args.record)
+    close_map()
+
+if event_log is not None:
+    event_log.close()